@@ -1,8 +1,16 @@
 import streamlit as st
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import time
+import json
+import threading
+import bisect
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from datetime import datetime
+from streamlit_autorefresh import st_autorefresh
 
 # ==============================================================================
 # 1. Dashboard Configuration
@@ -24,42 +32,264 @@ else:
     API_URL = f"http://{clean}:5050"
 
 REFRESH_RATE_SECONDS = 5
+MAX_REFRESH_RATE_SECONDS = 30
+# How long a failed poll is served to other viewers before anyone retries
+FAILED_POLL_HOLD_SECONDS = 1
+# Fields that tick on every poll and so say nothing about whether the system changed
+VOLATILE_STATUS_KEYS = ('uptime', 'uptime_str', 'next_temp_increase')
+STAGES = ("YELLOWING", "LEAF_DRYING", "MIDRIB_DRYING")
+STAGE_DISPLAY = {stage: stage.replace('_', ' ').title() for stage in STAGES}
+# (payload key, label, status field) for each manually switchable actuator
+ACTUATORS = (
+    ('fan1', 'Fan 1', 'fan_on'),
+    ('heater1', 'Heater 1', 'dehumidifier_on'),
+    ('fan2', 'Fan 2', 'fan_on_2'),
+    ('heater2', 'Heater 2', 'dehumidifier_on_2'),
+)
+TREND_KEYS = ('timestamps', 'temperature', 'humidity', 'target_temp')
+TREND_MAX_POINTS = 5000
+# Static Vega-Lite spec; the browser folds the series columns into lines
+TREND_CHART_SPEC = {
+    'transform': [{'fold': ['Temperature (°C)', 'Humidity (%)', 'Target Temp (°C)'], 'as': ['Series', 'Value']}],
+    'mark': 'line',
+    'encoding': {
+        'x': {'field': 'Time', 'type': 'ordinal', 'sort': None, 'axis': {'labelOverlap': True}},
+        'y': {'field': 'Value', 'type': 'quantitative', 'title': None},
+        'color': {'field': 'Series', 'type': 'nominal', 'title': None},
+        'tooltip': [{'field': 'Time'}, {'field': 'Series'}, {'field': 'Value', 'type': 'quantitative'}],
+    },
+}
 
 # ==============================================================================
 # 2. API Functions
 # ==============================================================================
 
-def get_status():
+@st.cache_resource
+def get_http_session():
+    """One pooled keep-alive session shared by every rerun and user."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=4,
+                          # Retry connection setup only; a Pi that accepts but hangs fails at once
+                          max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.2))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers.update({"Connection": "keep-alive"})
+    return session
+
+# Streamlit re-executes this script on every rerun, so the session lives in
+# st.cache_resource instead of a plain module global.
+SESSION = get_http_session()
+
+@st.cache_resource
+def get_fetch_executor():
+    """Worker pool used to overlap the status and trend requests."""
+    return ThreadPoolExecutor(max_workers=2, thread_name_prefix="api_fetch")
+
+def add_uptime_str(data):
+    """Adds the H:MM:SS 'uptime_str' display field to a status payload."""
+    hours, rem = divmod(int(data.get('uptime', 0)), 3600)
+    minutes, seconds = divmod(rem, 60)
+    data['uptime_str'] = f"{hours}:{minutes:02d}:{seconds:02d}"
+    return data
+
+def advance_counters(status, elapsed):
+    """Copy of a status payload with its live counters run forward by `elapsed` seconds."""
+    advanced = dict(status, uptime=status.get('uptime', 0) + elapsed)
+    if status.get('next_temp_increase', 0) > 0:
+        advanced['next_temp_increase'] = max(status['next_temp_increase'] - elapsed, 0)
+    return add_uptime_str(advanced)
+
+def get_status(cache):
+    # (received_at, payload) of the last full 200 response
+    base = cache['status_base'] if cache['status'] is not None else None
+    # Pis that version their state can answer 304 when nothing changed since `rev`
+    params = {'since': base[1]['rev']} if base and 'rev' in base[1] else {}
     try:
-        response = requests.get(f"{API_URL}/api/status", timeout=3)
+        response = SESSION.get(f"{API_URL}/api/status", params=params, timeout=(1, 3))
+        if response.status_code == 304:
+            # Only the counters move while `rev` holds; tick them locally
+            received_at, payload = base
+            return advance_counters(payload, time.monotonic() - received_at)
         response.raise_for_status()
-        data = response.json()
-        uptime_seconds = data.get('uptime', 0)
-        td = datetime.fromtimestamp(uptime_seconds) - datetime.fromtimestamp(0)
-        data['uptime_str'] = str(td).split('.')[0]
+        data = add_uptime_str(orjson.loads(response.content))
+        cache['status_base'] = (time.monotonic(), data)
         return data
     except Exception as e:
-        st.error(f"Connection Failed: {API_URL}")
-        st.info("💡 Tip: If using ngrok, ensure 'ngrok http 5050' is running on the Pi.")
         return None
 
 def post_control(endpoint, payload=None):
+    """Sends a command; used as a widget callback so the rerun that follows shows its effect."""
     try:
-        requests.post(f"{API_URL}/api/{endpoint}", json=payload, timeout=3)
+        response = SESSION.post(f"{API_URL}/api/{endpoint}", json=payload, timeout=(1, 3))
+        # An error reply (e.g. a Pi that doesn't serve /api/actuators yet) is a failure
+        response.raise_for_status()
+        # Make the next run see the command's effect instead of the cached poll.
+        # Bumping the generation also stops a fetch already in flight, which
+        # may predate the command, from marking its result fresh.
+        cache = get_shared_cache(API_URL)
+        cache['gen'] += 1
+        cache['t'] = 0.0
         st.toast("Command Sent!", icon='✅')
-        time.sleep(1)
-        st.rerun()
     except:
         st.toast("Command Failed", icon='❌')
 
-def get_trend_data():
-    """Fetches historical data for charting."""
+def apply_servo(key):
+    """Slider callback: sends the vent angle the user picked."""
+    post_control('servo', {'angle': st.session_state[key]})
+
+def actuator_key(name, reported):
+    """Widget key for an actuator checkbox, tied to the state the Pi reports."""
+    # A new reported state means a new widget, so a box never keeps a value
+    # the Pi has since overridden (AUTO logic, another viewer)
+    return f'act_{name}_{int(reported)}'
+
+def apply_actuators(current):
+    """Form callback: sends one request with only the actuators the user changed."""
+    changes = {}
+    for name, _, field in ACTUATORS:
+        reported = bool(current.get(field))
+        checked = st.session_state[actuator_key(name, reported)]
+        if checked != reported:
+            changes[name] = checked
+    if changes:
+        post_control('actuators', changes)
+
+def is_valid_trend(body):
+    """True if a trend response has an equal-length list for every trend column."""
+    return (isinstance(body, dict)
+            and all(isinstance(body.get(key), list) for key in TREND_KEYS)
+            and len({len(body[key]) for key in TREND_KEYS}) == 1)
+
+def merge_trend(cached, new):
+    """Appends newly fetched points (a valid trend body) to the cached trend log."""
+    new_ts = new['timestamps']
+    if not new_ts:
+        return cached or new
+    # A server that ignores `since` sends its whole window; take it as-is
+    if not cached or not cached['timestamps'] or new_ts[0] <= cached['timestamps'][0]:
+        merged, start = {key: [] for key in TREND_KEYS}, 0
+    else:
+        merged, start = cached, bisect.bisect_right(new_ts, cached['timestamps'][-1])
+    # Build new lists rather than extending, since other sessions may hold `cached`;
+    # every stored log is capped, so the chart never shrinks on a later poll
+    return {key: (merged[key] + new[key][start:])[-TREND_MAX_POINTS:] for key in TREND_KEYS}
+
+def get_trend_data(cache):
+    """Fetches only the trend points newer than the cached log, for charting."""
+    trend = cache['trend']
+    params, headers = {}, {}
+    if trend and trend['timestamps']:
+        params['since'] = trend['timestamps'][-1]
+        if cache['trend_etag']:
+            headers['If-None-Match'] = cache['trend_etag']
     try:
-        response = requests.get(f"{API_URL}/api/trend_data", timeout=2)
+        response = SESSION.get(f"{API_URL}/api/trend_data", params=params, headers=headers, timeout=(1, 2))
+        if response.status_code == 304:
+            return trend
         response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException:
-        return None
+        body = orjson.loads(response.content)
+        # A malformed body keeps the cached log, and its ETag is not kept either:
+        # revalidating against data we never merged could earn a 304 that hides it
+        if not is_valid_trend(body):
+            return trend
+        merged = merge_trend(trend, body)
+        cache['trend_etag'] = response.headers.get('ETag')
+        return merged
+    except (requests.exceptions.RequestException, orjson.JSONDecodeError, TypeError):
+        # TypeError: timestamps that don't compare with the cached ones
+        return trend
+
+def fetch_all(cache):
+    """Fetches status and trend data concurrently (one round-trip of wall time)."""
+    trend_future = get_fetch_executor().submit(get_trend_data, cache)
+    data = get_status(cache)
+    return data, trend_future.result()
+
+@st.cache_resource
+def get_shared_cache(api_url):
+    """Last poll of one Pi, shared by every session viewing it."""
+    return {'lock': threading.Lock(), 't': 0.0, 'gen': 0,
+            'status': None, 'status_base': None, 'trend': None, 'trend_etag': None}
+
+def fetch_shared():
+    """Single-flight fetch: concurrent viewers cost one upstream poll per refresh window."""
+    cache = get_shared_cache(API_URL)
+    # Hit path reads the fresh poll without taking the lock
+    if time.monotonic() - cache['t'] < REFRESH_RATE_SECONDS:
+        return cache['status'], cache['trend']
+    with cache['lock']:
+        # Re-check: another session may have refreshed while we waited
+        if time.monotonic() - cache['t'] >= REFRESH_RATE_SECONDS:
+            gen = cache['gen']
+            cache['status'], cache['trend'] = fetch_all(cache)
+            if cache['status'] is not None:
+                cache['t'] = time.monotonic()
+            else:
+                # Hold the failure briefly so viewers queued on the lock reuse it
+                # instead of each repeating the same slow, failing fetch
+                cache['t'] = time.monotonic() - REFRESH_RATE_SECONDS + FAILED_POLL_HOLD_SECONDS
+            # Checked after writing `t`: a command sent mid-fetch has either bumped
+            # `gen` by now, or will reset `t` itself right after bumping it
+            if cache['gen'] != gen:
+                cache['t'] = 0.0
+        return cache['status'], cache['trend']
+
+def next_refresh_interval_ms(data):
+    """Doubles the refresh interval while the status is unchanged, up to the cap."""
+    base_ms = REFRESH_RATE_SECONDS * 1000
+    if data is None:
+        # Disconnected: keep retrying at the base rate so a recovered Pi shows quickly
+        st.session_state.pop('_last_hash', None)
+        st.session_state['_interval_ms'] = base_ms
+        return base_ms
+
+    stable = {k: v for k, v in data.items() if k not in VOLATILE_STATUS_KEYS}
+    payload_hash = hash(json.dumps(stable, sort_keys=True, default=str))
+
+    if payload_hash == st.session_state.get('_last_hash'):
+        interval_ms = min(st.session_state.get('_interval_ms', base_ms) * 2,
+                          MAX_REFRESH_RATE_SECONDS * 1000)
+    else:
+        interval_ms = base_ms
+
+    st.session_state['_last_hash'] = payload_hash
+    st.session_state['_interval_ms'] = interval_ms
+    return interval_ms
+
+@st.cache_data(ttl=60, max_entries=4)
+def build_trend_df(n_points, last_ts, _trend_data):
+    """Builds the chart DataFrame with a local HH:MM:SS 'Time' column.
+
+    Cached on (n_points, last_ts) only; the leading underscore keeps Streamlit
+    from hashing the full log, so an unchanged log skips the rebuild.
+    """
+    # Same local-time (DST per point) labels as datetime.fromtimestamp(ts).strftime(...),
+    # about twice as fast since no datetime objects are built
+    times = [time.strftime('%H:%M:%S', time.localtime(ts)) for ts in _trend_data['timestamps']]
+    return pd.DataFrame({
+        'Time': times,
+        'Temperature (°C)': _trend_data['temperature'],
+        'Humidity (%)': _trend_data['humidity'],
+        'Target Temp (°C)': _trend_data['target_temp']
+    })
+
+def derive_display_state(data):
+    """Display strings derived from a status payload, computed once per payload."""
+    # The shared poll hands every run within a refresh window the same dict;
+    # holding the dict itself (not its id) means a new payload can't collide
+    cached = st.session_state.get('_derived')
+    if cached and cached[0] is data:
+        return cached[1]
+
+    next_increase_sec = data.get('next_temp_increase', 0)
+    derived = {
+        'fan_state': "ON" if data.get('fan_on') or data.get('fan_on_2') else "OFF",
+        'heater_state': "ON" if data.get('dehumidifier_on') or data.get('dehumidifier_on_2') else "OFF",
+        'next_increase_str': f"{int(next_increase_sec // 60):02d}:{int(next_increase_sec % 60):02d}"
+                             if next_increase_sec > 0 else "N/A",
+    }
+    st.session_state['_derived'] = (data, derived)
+    return derived
 
 # ==============================================================================
 # 3. Streamlit Dashboard Layout
@@ -70,26 +300,30 @@ def display_dashboard():
     st.info(f"Connected to: `{API_URL}`")
 
     # Fetch all data
-    data = get_status()
-    trend_data = get_trend_data()
+    data, trend_data = fetch_shared()
+
+    # Browser-side timer: the script returns right away instead of sleeping.
+    st_autorefresh(interval=next_refresh_interval_ms(data), key="dash_refresh")
     
     if data is None:
+        st.error(f"Connection Failed: {API_URL}")
+        st.info("💡 Tip: If using ngrok, ensure 'ngrok http 5050' is running on the Pi.")
         st.warning("Waiting for connection... ensure '16.py' is running on the Raspberry Pi.")
-        if st.button("Retry Connection"):
-            st.rerun()
+        # The click itself reruns the script; no explicit st.rerun() needed
+        st.button("Retry Connection")
         st.stop() 
         
     # --- 1. System Overview ---
     st.header("1. System Overview")
     col1, col2, col3, col4 = st.columns(4)
     
-    next_increase_sec = data.get('next_temp_increase', 0)
-    next_increase_str = f"{int(next_increase_sec // 60):02d}:{int(next_increase_sec % 60):02d}" if next_increase_sec > 0 else "N/A"
+    derived = derive_display_state(data)
 
     col1.metric("Mode", data.get('mode', 'N/A'))
-    col2.metric("Stage", data.get('stage', 'N/A').replace('_', ' '))
+    stage = data.get('stage', 'N/A')
+    col2.metric("Stage", STAGE_DISPLAY.get(stage, stage))
     col3.metric("Uptime", data.get('uptime_str', 'N/A'))
-    col4.metric("Next Temp Increase", next_increase_str)
+    col4.metric("Next Temp Increase", derived['next_increase_str'])
 
     st.divider()
     
@@ -104,11 +338,8 @@ def display_dashboard():
                     delta=f"Target: {target_temp:.1f} °C" if data.get('mode') == 'AUTO' else None)
     hum_col.metric("Humidity", f"{data.get('humidity', 0):.1f} %")
     
-    fan_state = "ON" if data.get('fan_on') or data.get('fan_on_2') else "OFF"
-    heater_state = "ON" if data.get('dehumidifier_on') or data.get('dehumidifier_on_2') else "OFF"
-    
-    target_col.metric("Heaters State", heater_state)
-    fan_col.metric("Fans State", fan_state)
+    target_col.metric("Heaters State", derived['heater_state'])
+    fan_col.metric("Fans State", derived['fan_state'])
 
     if data.get('buzzer_on'):
         st.warning("🚨 OVER-TEMP ALARM IS ACTIVE!", icon="⚠️")
@@ -118,13 +349,17 @@ def display_dashboard():
     # --- 3. Data Trend ---
     st.header("3. Data Trend")
     if trend_data and trend_data.get('timestamps'):
-        df = pd.DataFrame({
-            'Time': [datetime.fromtimestamp(ts).strftime('%H:%M:%S') for ts in trend_data['timestamps']],
-            'Temperature (°C)': trend_data['temperature'],
-            'Humidity (%)': trend_data['humidity'],
-            'Target Temp (°C)': trend_data['target_temp']
-        }).set_index('Time')
-        st.line_chart(df)
+        timestamps = trend_data['timestamps']
+        latest = (len(timestamps), timestamps[-1])
+        # Log hasn't advanced: reuse this session's frame and skip even the
+        # st.cache_data lookup, which unpickles a fresh copy on every hit
+        last_chart = st.session_state.get('_last_chart')
+        if last_chart and last_chart[0] == latest:
+            df = last_chart[1]
+        else:
+            df = build_trend_df(*latest, trend_data)
+            st.session_state['_last_chart'] = (latest, df)
+        st.vega_lite_chart(df, TREND_CHART_SPEC, use_container_width=True)
     else:
         st.info("No trend data available yet.")
         
@@ -136,41 +371,39 @@ def display_dashboard():
 
     with control_col:
         st.subheader("Mode & Reset")
-        if st.button(f"🔄 Toggle Mode ({data.get('mode')})", type="primary", use_container_width=True):
-            post_control('mode')
+        st.button(f"🔄 Toggle Mode ({data.get('mode')})", type="primary", use_container_width=True,
+                  on_click=post_control, args=('mode',))
             
-        if st.button("🔴 Reset System", use_container_width=True):
-            post_control('reset')
+        st.button("🔴 Reset System", use_container_width=True,
+                  on_click=post_control, args=('reset',))
 
     with stage_col:
         st.subheader("Change Stage")
-        STAGES = ["YELLOWING", "LEAF_DRYING", "MIDRIB_DRYING"]
         for stage in STAGES:
-            if st.button(stage.replace('_', ' ').title(), 
-                         disabled=(data.get('stage') == stage), 
-                         use_container_width=True):
-                post_control('stage', {'stage': stage})
+            st.button(STAGE_DISPLAY[stage], 
+                      disabled=(data.get('stage') == stage), 
+                      use_container_width=True,
+                      on_click=post_control, args=('stage', {'stage': stage}))
 
     with servo_col:
         st.subheader("Vent Control")
         current_angle = data.get('servo_angle', 0)
-        new_angle = st.select_slider('Set Vent Angle (°)', options=[0, 45, 90, 180], value=current_angle)
-        if new_angle != current_angle:
-            post_control('servo', {'angle': new_angle})
+        # Keyed on the reported angle so a change on the Pi resets the slider
+        servo_key = f'servo_{current_angle}'
+        st.select_slider('Set Vent Angle (°)', options=[0, 45, 90, 180], value=current_angle,
+                         key=servo_key, on_change=apply_servo, args=(servo_key,))
             
     # Manual Overrides
     if data.get('mode') == 'MANUAL':
         st.subheader("Manual Actuator Overrides")
-        m_col1, m_col2, m_col3, m_col4 = st.columns(4)
-        if m_col1.button("Toggle Fan 1"): post_control('fan1_toggle')
-        if m_col2.button("Toggle Heater 1"): post_control('heater1_toggle')
-        if m_col3.button("Toggle Fan 2"): post_control('fan2_toggle')
-        if m_col4.button("Toggle Heater 2"): post_control('heater2_toggle')
+        with st.form('actuators'):
+            for m_col, (name, label, field) in zip(st.columns(len(ACTUATORS)), ACTUATORS):
+                reported = bool(data.get(field))
+                m_col.checkbox(label, value=reported, key=actuator_key(name, reported))
+            st.form_submit_button("Apply", on_click=apply_actuators, args=(data,))
 
-    # --- Auto-Refresh ---
+    # Refresh is scheduled by st_autorefresh above; the run ends here
     st.caption(f"Last updated: {datetime.now().strftime('%H:%M:%S')}")
-    time.sleep(REFRESH_RATE_SECONDS)
-    st.rerun()
 
 if __name__ == '__main__':
     display_dashboard()